@@ -0,0 +1,90 @@
+# backend/app/kernels.py
+
+import numpy as np
+from numba import njit
+
+# --- NUMBA KERNELS ---
+
+@njit(nogil=True, fastmath=True, cache=True)
+def quantum_kernel(samples, mu, lower, risk_tolerance):
+    """Scores candidate long-only portfolios, one per row, as risk-tolerance-weighted return minus risk.
+
+    lower is the Cholesky factor of the covariance (sigma = lower lower'), so all
+    variances come from one (n_samples x n) @ (n x n) GEMM followed by row norms.
+    The GIL is released, so independent shards can be scored from a thread pool.
+    """
+    n_samples, n = samples.shape
+    rets = samples @ mu
+    projected = samples @ lower
+    scores = np.empty(n_samples)
+    for k in range(n_samples):
+        var = 0.0
+        for j in range(n):
+            var += projected[k, j] * projected[k, j]
+        scores[k] = rets[k] * risk_tolerance - np.sqrt(var) * (1 - risk_tolerance)
+    return scores
+
+@njit(nogil=True, cache=True)
+def project_capped_simplex(samples, cap):
+    """Projects each row of simplex samples, in place, onto {0 <= w <= cap, sum(w) = 1}.
+
+    The projection is clip(w - tau, 0, cap) with the shift tau found by bisection;
+    rows already under the cap are left untouched.
+    """
+    n_samples, n = samples.shape
+    for k in range(n_samples):
+        row = samples[k]
+        if row.max() <= cap:
+            continue
+        lo, hi = row.min() - cap, row.max()
+        for _ in range(50):
+            tau = 0.5 * (lo + hi)
+            total = 0.0
+            for j in range(n):
+                total += min(max(row[j] - tau, 0.0), cap)
+            if total > 1.0:
+                lo = tau
+            else:
+                hi = tau
+        tau = 0.5 * (lo + hi)
+        for j in range(n):
+            row[j] = min(max(row[j] - tau, 0.0), cap)
+    return samples
+
+@njit(nogil=True, fastmath=True, cache=True)
+def portfolio_metrics(w, mu, sigma):
+    """Return, risk and Sharpe ratio of one weight vector, with w' mu and w' sigma w fused in a single pass."""
+    n = w.shape[0]
+    ret = 0.0
+    var = 0.0
+    for i in range(n):
+        ret += mu[i] * w[i]
+        tmp = 0.0
+        for j in range(n):
+            tmp += sigma[i, j] * w[j]
+        var += w[i] * tmp
+    risk = np.sqrt(max(var, 0.0))
+    sharpe = ret / risk if risk > 0 else 0.0
+    return ret, risk, sharpe
+
+@njit(nogil=True, fastmath=True, cache=True)
+def portfolio_variance_and_grad(w, sigma):
+    """w' sigma w and its gradient 2 sigma w, sharing one sigma @ w pass; the SLSQP objective with jac=True."""
+    n = w.shape[0]
+    var = 0.0
+    grad = np.empty(n)
+    for i in range(n):
+        tmp = 0.0
+        for j in range(n):
+            tmp += sigma[i, j] * w[j]
+        var += w[i] * tmp
+        grad[i] = 2.0 * tmp
+    return var, grad
+
+@njit(nogil=True, cache=True)
+def budget_constraint(w):
+    return w.sum() - 1.0
+
+@njit(nogil=True, cache=True)
+def budget_constraint_jac(w):
+    return np.ones_like(w)
@@ -2,22 +2,34 @@
 
 import numpy as np
 import pandas as pd
-import yfinance as yf
 from scipy.optimize import minimize
+from scipy.linalg import cho_solve, LinAlgError
 from typing import List, Dict
 import warnings
+import hashlib
+import asyncio
+import threading
+import os
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import LRUCache, TTLCache, cached
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from sklearn.covariance import LedoitWolf
+from app.price_store import load_closes
+from app.kernels import (quantum_kernel, project_capped_simplex, portfolio_metrics,
+                         portfolio_variance_and_grad, budget_constraint, budget_constraint_jac)
 
 warnings.filterwarnings('ignore')
 
-app = FastAPI(title="Quantum Portfolio Optimizer Engine")
+app = FastAPI(title="Quantum Portfolio Optimizer Engine", default_response_class=ORJSONResponse)
 
 # Ensure your frontend URL is in this list for production
 origins = ["http://localhost:3002", "https://your-production-frontend-url.com","https://quantum-portfolio-optimizer-wine.vercel.app"]
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(GZipMiddleware, minimum_size=1024) # Covariance matrices in calculation_details grow as n^2
 
 # --- DATA MODELS ---
 class PortfolioRequest(BaseModel):
@@ -40,83 +52,180 @@ class ExistingPortfolioRequest(BaseModel):
 
 MAX_WEIGHT_PER_ASSET = 0.35 # Diversification constraint
 
+MARKET_DATA_TTL = 3600 # Seconds a downloaded price history is reused before refetching
+
+_price_cache = TTLCache(maxsize=2048, ttl=MARKET_DATA_TTL) # (ticker, start, end) -> close series
+_price_cache_lock = threading.Lock()
+
+def download_prices(tickers, start, end):
+    """Returns adjusted closes per ticker, only going to the on-disk store for tickers not cached yet."""
+    with _price_cache_lock:
+        prices = {t: _price_cache[(t, start, end)] for t in tickers if (t, start, end) in _price_cache}
+    missing = [t for t in tickers if t not in prices]
+    if missing:
+        downloaded = load_closes(missing, start, end)
+        with _price_cache_lock:
+            for t, closes in downloaded.items():
+                _price_cache[(t, start, end)] = prices[t] = closes
+    return pd.DataFrame(prices, columns=sorted(set(tickers)))
+
+def ewm_last(returns, span):
+    """Last row of pandas' adjusted exponentially weighted mean, as one weighted sum over time."""
+    alpha = 2.0 / (span + 1.0)
+    weights = (1 - alpha) ** np.arange(len(returns) - 1, -1, -1)
+    return weights @ returns / np.sum(weights)
+
+_moments_cache = LRUCache(maxsize=256) # returns digest -> (mu, sigma)
+_moments_cache_lock = threading.Lock()
+
+def estimate_moments(returns):
+    """Shrunk EWMA expected returns and Ledoit-Wolf covariance, memoized on the returns content."""
+    key = (returns.shape, hashlib.blake2b(returns.tobytes(), digest_size=16).digest())
+    with _moments_cache_lock:
+        moments = _moments_cache.get(key)
+    if moments is not None:
+        return moments
+
+    mu_hist = ewm_last(returns, span=180) * 252
+    mu_common = np.mean(mu_hist)
+    delta = 0.5 
+    mu = (1 - delta) * mu_hist + delta * mu_common
+
+    lw = LedoitWolf()
+    lw.fit(returns)
+    sigma = lw.covariance_ * 252
+
+    with _moments_cache_lock:
+        _moments_cache[key] = (mu, sigma)
+    return mu, sigma
+
 def get_market_data(tickers, start, end):
     """Downloads historical and latest market data using robust estimators."""
+    # Yahoo Finance symbols (and the price store's keys) are upper case; normalize once here
+    return _get_market_data(tuple(sorted({ticker.upper() for ticker in tickers})), start, end)
+
+@cached(cache=TTLCache(maxsize=512, ttl=MARKET_DATA_TTL), key=lambda tickers, start, end: (tickers, start, end),
+        lock=threading.Lock())
+def _get_market_data(tickers, start, end):
     try:
-        data = yf.download(tickers, start=start, end=end, auto_adjust=True, progress=False)
-        if data.empty:
+        adj_close = download_prices(tickers, start, end).dropna(how='all').ffill()
+        if adj_close.empty:
             raise ValueError("No data downloaded. Check tickers and date range.")
-        
-        adj_close = data['Close'].dropna(how='all').ffill()
         if adj_close.isnull().values.any():
              raise ValueError("Data contains missing values after forward fill. Try a different date range or tickers.")
-
-        if len(tickers) == 1:
-            adj_close = pd.DataFrame({tickers[0]: adj_close})
             
         latest_prices = adj_close.iloc[-1]
-        returns = adj_close.pct_change().dropna()
+        prices = adj_close.to_numpy(dtype=np.float64)
+        returns = prices[1:] / prices[:-1] - 1.0
         
         if len(returns) < 30:
             raise ValueError("Need at least 30 days of valid market data for analysis.")
 
-        mu_hist = returns.ewm(span=180).mean().iloc[-1] * 252
-        mu_common = np.mean(mu_hist)
-        delta = 0.5 
-        mu = (1 - delta) * mu_hist + delta * mu_common
-
-        lw = LedoitWolf()
-        lw.fit(returns)
-        sigma = lw.covariance_ * 252
+        mu, sigma = estimate_moments(returns)
             
-        return mu.values, sigma, returns.columns.tolist(), latest_prices
+        return mu, sigma, adj_close.columns.tolist(), latest_prices
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Market data error: {str(e)}")
 
 def calculate_metrics(weights, mu, sigma):
     """Calculate portfolio metrics: return, risk, sharpe ratio."""
-    weights = np.array(weights)
-    ret = np.sum(mu * weights)
-    risk = np.sqrt(np.dot(weights.T, np.dot(sigma, weights)))
-    sharpe = ret / risk if risk > 0 else 0
-    return ret, risk, sharpe
+    return portfolio_metrics(np.ascontiguousarray(weights, dtype=np.float64), mu, sigma)
+
+CHOLESKY_JITTER = 1e-12 # Keeps the factorization stable for nearly singular covariances
+
+def cholesky_factor(sigma):
+    """Lower Cholesky factor L of sigma, so that w' sigma w == ||L' w||^2."""
+    return np.linalg.cholesky(sigma + CHOLESKY_JITTER * np.eye(len(sigma)))
 
 def classical_gmv_optimization(mu, sigma):
+    """Global minimum variance weights: closed form when no bound binds, box-constrained QP otherwise."""
     n = len(mu)
-    def portfolio_variance(weights, sigma):
-        return calculate_metrics(weights, np.zeros(n), sigma)[1]**2 
-    constraints = [{'type': 'eq', 'fun': lambda w: np.sum(w) - 1}]
+    equal_weights = np.ones(n) / n
+    initial_weights = equal_weights
+    try:
+        inv_ones = cho_solve((cholesky_factor(sigma), True), np.ones(n))
+        weights = inv_ones / np.sum(inv_ones)
+        if np.all(weights >= 0) and np.all(weights <= MAX_WEIGHT_PER_ASSET):
+            return weights
+        # Warm start from the unconstrained optimum projected onto the feasible set
+        clipped = np.maximum(weights, 0.0)
+        initial_weights = project_capped_simplex((clipped / clipped.sum())[None, :], MAX_WEIGHT_PER_ASSET)[0]
+    except LinAlgError:
+        pass
+    constraints = [{'type': 'eq', 'fun': budget_constraint, 'jac': budget_constraint_jac}]
     bounds = tuple((0.0, MAX_WEIGHT_PER_ASSET) for _ in range(n))
-    initial_weights = np.ones(n) / n
-    result = minimize(portfolio_variance, initial_weights, args=(sigma,), method='SLSQP', bounds=bounds, constraints=constraints)
-    return result.x if result.success else initial_weights
+    result = minimize(portfolio_variance_and_grad, initial_weights, args=(sigma,), jac=True,
+                      method='SLSQP', bounds=bounds, constraints=constraints,
+                      options={'ftol': 1e-10}) # Variances are ~1e-2, so the default 1e-6 stops short of the optimum
+    return result.x if result.success else equal_weights
 
-def quantum_inspired_optimization(mu, sigma, risk_tolerance):
-    n = len(mu)
-    best_weights = None
-    best_score = -float('inf')
-    for _ in range(2000): 
-        weights = np.random.random(n)
-        weights /= np.sum(weights)
-        if np.any(weights > MAX_WEIGHT_PER_ASSET):
-            penalty = 1e9
-        else:
-            penalty = 0
-        ret, risk, _ = calculate_metrics(weights, mu, sigma)
-        score = (ret * risk_tolerance - risk * (1 - risk_tolerance)) - penalty
-        if score > best_score:
-            best_score = score
-            best_weights = weights
-    return best_weights if best_weights is not None else np.ones(n) / n
+QUANTUM_SAMPLES = 100 # Candidates drawn per cross-entropy round
+QUANTUM_ROUNDS = 10 # Cross-entropy refinement rounds per shard
+QUANTUM_ELITE = 10 # Best candidates whose mean re-centres the next round
+QUANTUM_SHARDS = 2 # Independent searches per request; fixed so a seed gives the same weights on any host
+
+_quantum_executor = ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, QUANTUM_SHARDS))
+
+def _quantum_shard(seed_seq, mu32, lower32, risk_tolerance):
+    """Runs one cross-entropy search on its own random stream and returns its best (weights, score)."""
+    rng = np.random.default_rng(seed_seq)
+    n = len(mu32)
+    alpha = np.ones(n) # Uniform over the simplex to start
+    concentration = 5.0 * n
+    # With too few assets for the cap to reach a full allocation, drop it (as the old uniform penalty did)
+    cap = MAX_WEIGHT_PER_ASSET if n * MAX_WEIGHT_PER_ASSET >= 1 else 1.0
+    best, best_score = None, -np.inf
+    for _ in range(QUANTUM_ROUNDS):
+        samples = project_capped_simplex(rng.dirichlet(alpha, size=QUANTUM_SAMPLES), cap)
+        scores = quantum_kernel(samples.astype(np.float32), mu32, lower32, risk_tolerance)
+        elite = np.argpartition(scores, -QUANTUM_ELITE)[-QUANTUM_ELITE:]
+        top = elite[np.argmax(scores[elite])]
+        if scores[top] > best_score:
+            best, best_score = samples[top], scores[top]
+        alpha = np.maximum(concentration * samples[elite].mean(axis=0), 0.05) # Floor keeps every asset reachable
+    return best, best_score
+
+def quantum_inspired_optimization(mu, sigma, risk_tolerance, seed=None):
+    """Cross-entropy search over capped long-only portfolios, run as parallel independent shards."""
+    mu32 = np.ascontiguousarray(mu, dtype=np.float32)
+    lower32 = np.ascontiguousarray(cholesky_factor(sigma), dtype=np.float32)
+    seed_seqs = np.random.SeedSequence(seed).spawn(QUANTUM_SHARDS)
+    futures = [_quantum_executor.submit(_quantum_shard, seq, mu32, lower32, float(risk_tolerance)) for seq in seed_seqs]
+    best, _ = max((future.result() for future in futures), key=lambda result: result[1])
+    return best / best.sum()
+
+_ACTION = {1: "BUY", 0: "HOLD", -1: "SELL"}
+
+def calculate_trades(target_weights, prices, current_shares, total_value, tickers):
+    """Share trades that move current holdings to target weights, given aligned price/share arrays."""
+    target_shares = target_weights * total_value / prices
+    trade_amounts = target_shares - current_shares
+    codes = (trade_amounts > 0.01).astype(np.int8) - (trade_amounts < -0.01).astype(np.int8) # 1 / 0 / -1
+    amounts = np.abs(trade_amounts).tolist()
+    return [
+        {"ticker": ticker, "current_shares": current, "target_shares": target, "action": _ACTION[code], "amount": amount}
+        for ticker, current, target, code, amount in zip(
+            tickers, current_shares.tolist(), target_shares.tolist(), codes.tolist(), amounts)
+    ]
 
 # --- API ENDPOINTS ---
 
+@app.on_event("startup")
+def warm_up_optimizers():
+    """Compiles (or loads from Numba's on-disk cache) every kernel before the first request arrives."""
+    mu = np.full(4, 0.1)
+    sigma = np.diag([0.01, 0.05, 0.06, 0.07]) # Unconstrained GMV breaks the weight cap, so SLSQP runs too
+    classical_gmv_optimization(mu, sigma)
+    quantum_inspired_optimization(mu, sigma, 0.5, seed=0)
+    calculate_metrics(np.full(4, 0.25), mu, sigma)
+
 @app.post("/optimize")
 async def optimize_portfolio(request: PortfolioRequest):
-    mu, sigma, ordered_tickers, _ = get_market_data(request.tickers, request.start_date, request.end_date)
+    mu, sigma, ordered_tickers, _ = await asyncio.to_thread(get_market_data, request.tickers, request.start_date, request.end_date)
     
-    classical_weights = classical_gmv_optimization(mu, sigma)
-    quantum_weights = quantum_inspired_optimization(mu, sigma, request.risk_tolerance)
+    classical_weights, quantum_weights = await asyncio.gather(
+        asyncio.to_thread(classical_gmv_optimization, mu, sigma),
+        asyncio.to_thread(quantum_inspired_optimization, mu, sigma, request.risk_tolerance))
     
     c_ret, c_risk, c_sharpe = calculate_metrics(classical_weights, mu, sigma)
     q_ret, q_risk, q_sharpe = calculate_metrics(quantum_weights, mu, sigma)
@@ -125,34 +234,36 @@ async def optimize_portfolio(request: PortfolioRequest):
     
     calculation_details = {
         "tickers": ordered_tickers,
-        "expected_returns": mu.tolist(),
-        "covariance_matrix": sigma.tolist()
+        "expected_returns": mu,
+        "covariance_matrix": sigma
     }
     
-    return {
+    # Returning the response directly skips jsonable_encoder; orjson serializes the ndarrays in C
+    return ORJSONResponse({
         "tickers": ordered_tickers,
-        "classical_weights": classical_weights.tolist(),
+        "classical_weights": classical_weights,
         "classical_return": c_ret, "classical_risk": c_risk, "classical_sharpe": c_sharpe,
-        "quantum_weights": quantum_weights.tolist(),
+        "quantum_weights": quantum_weights,
         "quantum_return": q_ret, "quantum_risk": q_risk, "quantum_sharpe": q_sharpe,
         "improvement_percent": improvement,
         "calculation_details": calculation_details
-    }
+    })
 
 @app.post("/optimize-existing")
 async def optimize_existing_portfolio(request: ExistingPortfolioRequest):
     tickers = [asset.ticker for asset in request.assets]
-    current_shares_map = {asset.ticker: asset.shares for asset in request.assets}
+    current_shares_map = {asset.ticker.upper(): asset.shares for asset in request.assets}
     
-    mu, sigma, ordered_tickers, latest_prices = get_market_data(tickers, request.start_date, request.end_date)
+    mu, sigma, ordered_tickers, latest_prices = await asyncio.to_thread(get_market_data, tickers, request.start_date, request.end_date)
     
-    current_shares = np.array([current_shares_map.get(ticker, 0) for ticker in ordered_tickers])
+    current_shares = np.array([current_shares_map.get(ticker, 0) for ticker in ordered_tickers], dtype=np.float64)
     
     # Ensure latest_prices is a pandas Series for proper alignment
     if not isinstance(latest_prices, pd.Series):
         latest_prices = pd.Series(latest_prices, index=ordered_tickers)
+    prices = latest_prices.reindex(ordered_tickers).to_numpy(dtype=np.float64)
 
-    current_values = current_shares * latest_prices.reindex(ordered_tickers).values
+    current_values = current_shares * prices
     total_portfolio_value = np.sum(current_values)
     
     if total_portfolio_value == 0:
@@ -162,48 +273,31 @@ async def optimize_existing_portfolio(request: ExistingPortfolioRequest):
     
     current_ret, current_risk, current_sharpe = calculate_metrics(current_weights, mu, sigma)
 
-    classical_target_weights = classical_gmv_optimization(mu, sigma)
-    quantum_target_weights = quantum_inspired_optimization(mu, sigma, request.risk_tolerance)
+    classical_target_weights, quantum_target_weights = await asyncio.gather(
+        asyncio.to_thread(classical_gmv_optimization, mu, sigma),
+        asyncio.to_thread(quantum_inspired_optimization, mu, sigma, request.risk_tolerance))
     
     c_ret, c_risk, c_sharpe = calculate_metrics(classical_target_weights, mu, sigma)
     q_ret, q_risk, q_sharpe = calculate_metrics(quantum_target_weights, mu, sigma)
     
-    def calculate_trades(target_weights):
-        trades = []
-        target_values = target_weights * total_portfolio_value
-        target_shares = target_values / latest_prices.reindex(ordered_tickers).values
-        trade_amounts = target_shares - current_shares
-        
-        for i, ticker in enumerate(ordered_tickers):
-            amount = trade_amounts[i]
-            action = "HOLD"
-            if amount > 0.01: action = "BUY"
-            elif amount < -0.01: action = "SELL"
-            trades.append({
-                "ticker": ticker, "current_shares": float(current_shares[i]),
-                "target_shares": float(target_shares[i]), "action": action,
-                "amount": abs(float(amount))
-            })
-        return trades
-
-    quantum_trades = calculate_trades(quantum_target_weights)
-    classical_trades = calculate_trades(classical_target_weights)
+    quantum_trades = calculate_trades(quantum_target_weights, prices, current_shares, total_portfolio_value, ordered_tickers)
+    classical_trades = calculate_trades(classical_target_weights, prices, current_shares, total_portfolio_value, ordered_tickers)
     
     # --- NEW: ADD CALCULATION DETAILS TO RESPONSE ---
     calculation_details = {
         "tickers": ordered_tickers,
-        "expected_returns": mu.tolist(),
-        "covariance_matrix": sigma.tolist()
+        "expected_returns": mu,
+        "covariance_matrix": sigma
     }
 
-    return {
+    return ORJSONResponse({
         "quantum_trades": quantum_trades,
         "classical_trades": classical_trades,
         "current_portfolio_metrics": { "return": current_ret, "risk": current_risk, "sharpe": current_sharpe },
         "quantum_portfolio_metrics": { "return": q_ret, "risk": q_risk, "sharpe": q_sharpe },
         "classical_portfolio_metrics": { "return": c_ret, "risk": c_risk, "sharpe": c_sharpe },
         "calculation_details": calculation_details # Embed the new data object
-    }
+    })
 
 @app.get("/health")
 async def health():
@@ -211,7 +305,8 @@ async def health():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Requests are CPU-bound, so scale across processes; BLAS threads are capped per worker in the Dockerfile
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8000, workers=max((os.cpu_count() or 1) // 2, 1))
 
         # PS C:\personal stuff\WEB D\projects\Quantum Portfolio Optimizer\backend> wsl
         # root@LAPTOP-3JCHER86:/mnt/c/personal stuff/WEB D/projects/Quantum Portfolio Optimizer/backend# source venv/bin/activate
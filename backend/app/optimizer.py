@@ -1,100 +1,252 @@
+import os
+import threading
 import numpy as np
 import pandas as pd
 import yfinance as yf
-from scipy.optimize import minimize
-import cirq
-import sympy
-import tensorflow as tf
-import tensorflow_quantum as tfq
+import scipy.sparse as sp
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
+import osqp
+from functools import lru_cache
+
+# The cirq/TensorFlow Quantum stack is imported inside the QAOA functions, so the classical
+# and exact-enumeration paths never pay its import time and memory
+os.environ.setdefault('TF_GPU_ALLOCATOR', 'cuda_malloc_async') # Must be set before TensorFlow initializes the GPU
 
 # --- Classical Optimization Logic ---
 def portfolio_variance(weights, sigma):
-    return np.sqrt(np.dot(weights.T, np.dot(sigma, weights)))
+    return float(np.sqrt(np.einsum('i,ij,j->', weights, sigma, weights)))
+
+_variance_qp_lock = threading.Lock() # Cached OSQP solvers keep mutable workspace and warm-start state
+
+@lru_cache(maxsize=32)
+def _variance_qp(sigma_bytes, n):
+    """OSQP solver for min w' sigma w s.t. sum(w) = 1, 0 <= w <= 1, set up once per covariance matrix."""
+    sigma = np.frombuffer(sigma_bytes, dtype=np.float64).reshape(n, n)
+    P = sp.triu(sp.csc_matrix(2.0 * sigma), format='csc')
+    A = sp.vstack([sp.csc_matrix(np.ones((1, n))), sp.eye(n, format='csc')], format='csc')
+    lower = np.concatenate(([1.0], np.zeros(n)))
+    upper = np.ones(n + 1)
+    solver = osqp.OSQP()
+    solver.setup(P, np.zeros(n), A, lower, upper, eps_abs=1e-9, eps_rel=1e-9, polish=True, verbose=False)
+    return solver
 
 def classic_optimize_portfolio(mu, sigma):
     n = len(mu)
-    def objective(weights):
-        return np.dot(weights.T, np.dot(sigma, weights))
-    
-    constraints = ({'type': 'eq', 'fun': lambda weights: np.sum(weights) - 1})
-    bounds = tuple((0, 1) for _ in range(n))
     initial_weights = np.ones(n) / n
+    sigma = np.ascontiguousarray(sigma, dtype=np.float64)
+    try:
+        # Long-only bounds rarely bind: then the unconstrained optimum sigma^-1 1 / (1' sigma^-1 1) is the answer
+        inv_ones = cho_solve(cho_factor(sigma), np.ones(n))
+        weights = inv_ones / np.sum(inv_ones)
+        if np.all(weights >= 0):
+            return weights
+    except LinAlgError:
+        pass
+    solver = _variance_qp(sigma.tobytes(), n)
+    with _variance_qp_lock:
+        result = solver.solve()
+        status, x = result.info.status_val, np.array(result.x) # Copy out before another solve reuses the buffers
     
-    result = minimize(objective, initial_weights, method='SLSQP', bounds=bounds, constraints=constraints)
-    
-    if result.success:
-        return result.x
+    if status in (osqp.constant('OSQP_SOLVED'), osqp.constant('OSQP_SOLVED_INACCURATE')):
+        weights = np.clip(x, 0.0, 1.0)
+        return weights / np.sum(weights)
     else:
         # Fallback if optimization fails
         return initial_weights
 
 # --- Quantum Optimization Logic ---
-def quantum_optimize_portfolio(mu_quantum, sigma_quantum, num_assets_quantum=2):
+QSIM_FUSED_GATE_SIZE = 4 # qsim merges gates on up to this many qubits into one dense matrix
+
+def _make_simulator():
+    """qsim on the GPU (cuStateVec) when a CUDA device is visible and qsimcirq was built for it, CPU qsim otherwise."""
+    import qsimcirq
+    import tensorflow as tf
+    if tf.config.list_physical_devices('GPU'):
+        try:
+            return qsimcirq.QSimSimulator(qsim_options=qsimcirq.QSimOptions(use_gpu=True, gpu_mode=1,
+                                                                             max_fused_gate_size=QSIM_FUSED_GATE_SIZE))
+        except ValueError:
+            pass
+    return qsimcirq.QSimSimulator(qsim_options=qsimcirq.QSimOptions(cpu_threads=os.cpu_count() or 1,
+                                                                     max_fused_gate_size=QSIM_FUSED_GATE_SIZE))
+
+_simulators = threading.local()
+
+def _simulator():
+    """This thread's qsim simulator, created on first use and reused across calls."""
+    if not hasattr(_simulators, "qsim"):
+        _simulators.qsim = _make_simulator()
+    return _simulators.qsim
+
+QUBO_PENALTY = 10.0 # Weight of the (sum(x) - 1)^2 term pushing towards selecting a single asset
+EXACT_MAX_ASSETS = 12 # Up to 2^12 bitstrings are cheaper to enumerate than one QAOA training run
+
+def _exact_bitstring(sigma_quantum, num_assets_quantum, penalty):
+    """Ground state of the QUBO by scoring every bitstring; the state QAOA only approximates."""
+    codes = np.arange(2 ** num_assets_quantum)
+    bits = ((codes[:, None] >> np.arange(num_assets_quantum - 1, -1, -1)) & 1).astype(np.float64)
+    energies = np.einsum('ki,ij,kj->k', bits, sigma_quantum, bits) + penalty * (bits.sum(axis=1) - 1) ** 2
+    return int(np.argmin(energies))
+
+QAOA_MAX_STEPS = 100 # Adam steps when the loss keeps improving
+QAOA_LOSS_TOL = 1e-5 # Loss changes below this count as a plateau
+QAOA_PATIENCE = 5 # Consecutive plateau steps before training stops early
+QAOA_GRID = 8 # Initial (gamma, beta) candidates per axis, all scored in one batched Expectation call
+
+_qaoa_programs = {}
+_qaoa_lock = threading.Lock()
+
+def _qaoa_program(num_assets_quantum):
+    """Symbolic p=1 QAOA circuit, Expectation layer and traced train step for n qubits, built once per size.
+
+    Every cost term gets its own angle symbol, fed as coeff * gamma at run time, so the
+    circuit tensor and the traced graph do not depend on the covariance matrix.
+    """
+    import cirq
+    import sympy
+    import tensorflow as tf
+    import tensorflow_quantum as tfq
+    if num_assets_quantum in _qaoa_programs:
+        return _qaoa_programs[num_assets_quantum]
+
     qubits = [cirq.GridQubit(0, i) for i in range(num_assets_quantum)]
-    cost_hamiltonian = cirq.PauliSum()
-
-    for i in range(num_assets_quantum):
-        for j in range(num_assets_quantum):
-            coeff = sigma_quantum[i, j] / 4.0
-            cost_hamiltonian += coeff * (1 - cirq.Z(qubits[i])) * (1 - cirq.Z(qubits[j]))
-
-    penalty = 10.0
-    constraint_hamiltonian = (sum((1 - cirq.Z(q)) / 2.0 for q in qubits) - 1)**2
-    cost_hamiltonian += penalty * constraint_hamiltonian
-
-    def create_qaoa_circuit(gamma, beta):
-        circuit = cirq.Circuit()
-        circuit.append(cirq.H.on_each(*qubits))
-        for term in cost_hamiltonian:
-            qubits_in_term = list(term.qubits)
-            coeff = term.coefficient.real
-            if len(qubits_in_term) == 2:
-                q1, q2 = qubits_in_term[0], qubits_in_term[1]
-                circuit.append(cirq.ZZ(q1, q2)**(2 * coeff * gamma / np.pi))
-            elif len(qubits_in_term) == 1:
-                q1 = qubits_in_term[0]
-                circuit.append(cirq.rz(2 * coeff * gamma)(q1))
-        circuit.append(cirq.rx(2 * beta).on_each(*qubits))
-        return circuit
-
-    gamma_sym, beta_sym = sympy.symbols('gamma beta')
-    qaoa_circuit_symbolic = create_qaoa_circuit(gamma_sym, beta_sym)
-    
-    symbol_names = ['gamma', 'beta']
-    symbol_values = tf.Variable([0.5, 0.5], dtype=tf.float64)
-    expectation_layer = tfq.layers.Expectation()
+    rows, cols = np.triu_indices(num_assets_quantum, 1)
+    zz_symbols = [sympy.Symbol(f'zz_{i}_{j}') for i, j in zip(rows, cols)]
+    z_symbols = [sympy.Symbol(f'z_{i}') for i in range(num_assets_quantum)]
+    beta_sym = sympy.Symbol('beta')
+
+    # Each layer (H, ZZ, Rz, Rx) starts a fresh moment so qsim's fuser can merge it into dense blocks
+    layer = cirq.InsertStrategy.NEW_THEN_INLINE
+    circuit = cirq.Circuit()
+    circuit.append(cirq.H.on_each(*qubits), strategy=layer)
+    circuit.append([cirq.ZZ(qubits[i], qubits[j])**s for i, j, s in zip(rows, cols, zz_symbols)], strategy=layer)
+    circuit.append([cirq.rz(s)(q) for q, s in zip(qubits, z_symbols)], strategy=layer)
+    circuit.append(cirq.rx(2 * beta_sym).on_each(*qubits), strategy=layer)
+
+    symbol_names = [str(s) for s in zz_symbols + z_symbols + [beta_sym]]
+    circuit_tensor = tfq.convert_to_tensor([circuit])
+    params = tf.Variable([0.5, 0.5], dtype=tf.float32) # gamma, beta in float32, the precision of TFQ's simulation ops
+    expectation_layer = tfq.layers.Expectation() # Default backend is TFQ's native qsim op, faster than any Python simulator backend
     optimizer = tf.keras.optimizers.Adam(learning_rate=0.05)
 
-    for _ in range(100):
+    def symbol_values(angle_scales, candidates=None):
+        candidates = params[tf.newaxis, :] if candidates is None else candidates
+        return tf.concat([candidates[:, :1] * angle_scales[tf.newaxis, :], candidates[:, 1:]], axis=1)
+
+    batch_circuit_tensor = tf.tile(circuit_tensor, [QAOA_GRID ** 2])
+
+    @tf.function
+    def evaluate_candidates(candidates, angle_scales, operator_tensor):
+        # One Expectation call for the whole (gamma, beta) grid instead of one per point
+        return expectation_layer(batch_circuit_tensor, symbol_names=symbol_names,
+                                 symbol_values=symbol_values(angle_scales, candidates),
+                                 operators=tf.tile(operator_tensor, [QAOA_GRID ** 2, 1]))[:, 0]
+
+    @tf.function
+    def train_step(angle_scales, operator_tensor):
+        # Traced once per size; later calls only feed new coefficients and variable values through the graph
         with tf.GradientTape() as tape:
-            loss_value = expectation_layer(qaoa_circuit_symbolic, symbol_names=symbol_names,
-                                           symbol_values=[symbol_values], operators=[cost_hamiltonian])
-        grads = tape.gradient(loss_value, [symbol_values])
-        optimizer.apply_gradients(zip(grads, [symbol_values]))
-
-    optimized_gamma, optimized_beta = symbol_values.numpy()
-    optimized_circuit = create_qaoa_circuit(optimized_gamma, optimized_beta)
-    measured_circuit = optimized_circuit + cirq.measure(*qubits, key='result')
+            loss_value = expectation_layer(circuit_tensor, symbol_names=symbol_names,
+                                           symbol_values=symbol_values(angle_scales), operators=operator_tensor)
+        grads = tape.gradient(loss_value, [params])
+        optimizer.apply_gradients(zip(grads, [params]))
+        return loss_value
+
+    program = {"circuit": circuit, "symbol_names": symbol_names, "params": params,
+               "optimizer": optimizer, "symbol_values": symbol_values, "train_step": train_step,
+               "evaluate_candidates": evaluate_candidates}
+    _qaoa_programs[num_assets_quantum] = program
+    return program
+
+@lru_cache(maxsize=32)
+def _qaoa_problem(sigma_bytes, num_assets_quantum, penalty):
+    """Operator tensor, per-term angle scales and starting (gamma, beta) grid for one QUBO, built once per covariance."""
+    import cirq
+    import tensorflow as tf
+    import tensorflow_quantum as tfq
+    sigma_quantum = np.frombuffer(sigma_bytes, dtype=np.float64).reshape(num_assets_quantum, num_assets_quantum)
+    qubits = [cirq.GridQubit(0, i) for i in range(num_assets_quantum)]
+    # x' sigma x + penalty * (sum(x) - 1)^2 over bits x_i = (1 - Z_i) / 2, expanded into
+    # identity, Z_i and Z_i Z_j coefficients so the PauliSum is built in one shot
+    quadratic = sigma_quantum + penalty
+    quadratic = (quadratic + quadratic.T) / 2
+    linear = np.diag(quadratic) - 2 * penalty
+    pair = 2 * np.triu(quadratic, 1)
+    constant = penalty + linear.sum() / 2 + pair.sum() / 4
+    z_coeffs = -linear / 2 - (pair + pair.T).sum(axis=1) / 4
+    rows, cols = np.triu_indices(num_assets_quantum, 1)
+    cost_hamiltonian = cirq.PauliSum.from_pauli_strings(
+        [cirq.PauliString(coefficient=float(constant))]
+        + [cirq.PauliString(cirq.Z(qubits[i]), coefficient=float(z_coeffs[i])) for i in range(num_assets_quantum)]
+        + [cirq.PauliString(cirq.Z(qubits[i]), cirq.Z(qubits[j]), coefficient=float(pair[i, j] / 4))
+           for i, j in zip(rows, cols)])
+    operator_tensor = tfq.convert_to_tensor([[cost_hamiltonian]])
+    # exp(-i gamma c ZZ) is ZZ**(2 c gamma / pi) and exp(-i gamma c Z) is rz(2 c gamma)
+    angle_scales = tf.constant(np.concatenate((pair[rows, cols] / (2 * np.pi), 2 * z_coeffs)), dtype=tf.float32)
+    # Start Adam from the best point of a grid spanning one period of the fastest cost term in gamma, and of the mixer in beta
+    gamma_period = np.pi / max(np.abs(z_coeffs).max(), np.abs(pair).max() / 4)
+    gammas = gamma_period * (np.arange(QAOA_GRID) + 0.5) / QAOA_GRID
+    betas = np.pi * (np.arange(QAOA_GRID) + 0.5) / QAOA_GRID
+    candidates = tf.constant(np.stack(np.meshgrid(gammas, betas, indexing='ij'), axis=-1).reshape(-1, 2), dtype=tf.float32)
+    return operator_tensor, angle_scales, candidates
+
+def _qaoa_bitstring(sigma_quantum, num_assets_quantum, penalty):
+    """Most likely bitstring of a p=1 QAOA circuit trained on the QUBO with TFQ."""
+    import cirq
+    import tensorflow as tf
+    qubits = [cirq.GridQubit(0, i) for i in range(num_assets_quantum)]
+    operator_tensor, angle_scales, candidates = _qaoa_problem(
+        np.ascontiguousarray(sigma_quantum).tobytes(), num_assets_quantum, penalty)
+
+    with _qaoa_lock: # The cached variables and optimizer state are shared by every caller of this size
+        program = _qaoa_program(num_assets_quantum)
+        energies = program["evaluate_candidates"](candidates, angle_scales, operator_tensor)
+        program["params"].assign(candidates[int(tf.argmin(energies))])
+        for variable in program["optimizer"].variables:
+            variable.assign(tf.zeros_like(variable)) # Fresh Adam moments and step count for every problem
+        previous_loss, flat_steps = np.inf, 0
+        for _ in range(QAOA_MAX_STEPS):
+            loss = float(program["train_step"](angle_scales, operator_tensor)[0, 0])
+            flat_steps = flat_steps + 1 if abs(loss - previous_loss) < QAOA_LOSS_TOL else 0
+            if flat_steps >= QAOA_PATIENCE:
+                break
+            previous_loss = loss
+        resolved_values = program["symbol_values"](angle_scales).numpy()[0]
+
+    optimized_circuit = cirq.resolve_parameters(program["circuit"], dict(zip(program["symbol_names"], resolved_values.tolist())))
     
-    simulator = cirq.Simulator()
-    result = simulator.run(measured_circuit, repetitions=1000)
-    histogram = result.histogram(key='result')
-    most_frequent_bitstring = max(histogram, key=histogram.get)
+    # The most likely bitstring read straight off the final amplitudes (the limit of the most frequent shot)
+    simulator = _simulator()
+    state = simulator.simulate(optimized_circuit, qubit_order=qubits).final_state_vector
+    return int(np.argmax(np.abs(state) ** 2))
+
+def _runs_qaoa(num_assets_quantum, use_qaoa):
+    """Whether quantum_optimize_portfolio trains QAOA rather than enumerating the QUBO exactly."""
+    return use_qaoa or num_assets_quantum > EXACT_MAX_ASSETS
+
+def quantum_optimize_portfolio(mu_quantum, sigma_quantum, num_assets_quantum=2, use_qaoa=False):
+    sigma_quantum = np.asarray(sigma_quantum, dtype=np.float64)
+    if _runs_qaoa(num_assets_quantum, use_qaoa):
+        most_frequent_bitstring = _qaoa_bitstring(sigma_quantum, num_assets_quantum, QUBO_PENALTY)
+    else:
+        most_frequent_bitstring = _exact_bitstring(sigma_quantum, num_assets_quantum, QUBO_PENALTY)
     
-    weights_quantum = np.array([int(bit) for bit in f'{most_frequent_bitstring:0{num_assets_quantum}b}'])
+    weights_quantum = ((most_frequent_bitstring >> np.arange(num_assets_quantum - 1, -1, -1)) & 1).astype(np.float64)
     if np.sum(weights_quantum) > 0:
         weights_quantum = weights_quantum / np.sum(weights_quantum)
         
     return weights_quantum
 
 # --- Main Orchestration Function ---
-def run_optimization(tickers: list[str]):
+def run_optimization(tickers: list[str], use_qaoa: bool = False):
     # 1. Data Fetching
     data = yf.download(tickers, start="2023-01-01", end="2023-12-31", auto_adjust=False, progress=False)
-    adj_close = data['Adj Close']
-    returns = adj_close.pct_change().dropna()
-    mu = returns.mean().values * 252
-    sigma = returns.cov().values * np.sqrt(252)
+    # Forward-fill like pct_change's default padding, so holiday gaps in one ticker keep their return
+    prices = data['Adj Close'].ffill().to_numpy(dtype=np.float64)
+    returns = prices[1:] / prices[:-1] - 1
+    returns = returns[~np.isnan(returns).any(axis=1)] # Only leading rows before every ticker has a price
+    mu = returns.mean(axis=0) * 252
+    sigma = np.cov(returns, rowvar=False) * np.sqrt(252)
 
     # 2. Classical Optimization
     weights_classical = classic_optimize_portfolio(mu, sigma)
@@ -105,7 +257,8 @@ def run_optimization(tickers: list[str]):
     num_assets_quantum = 2
     mu_quantum = mu[:num_assets_quantum]
     sigma_quantum = sigma[:num_assets_quantum, :num_assets_quantum]
-    weights_quantum_subset = quantum_optimize_portfolio(mu_quantum, sigma_quantum, num_assets_quantum)
+    weights_quantum_subset = quantum_optimize_portfolio(mu_quantum, sigma_quantum, num_assets_quantum, use_qaoa)
+    method = "QAOA performed" if _runs_qaoa(num_assets_quantum, use_qaoa) else "Exact QUBO ground state computed"
     
     # Pad quantum weights to full portfolio size
     weights_quantum = np.zeros(len(tickers))
@@ -126,7 +279,7 @@ def run_optimization(tickers: list[str]):
             "weights": weights_quantum.tolist(),
             "return": return_quantum,
             "risk": risk_quantum,
-            "info": f"QAOA performed on the first {num_assets_quantum} assets: {', '.join(tickers[:num_assets_quantum])}"
+            "info": f"{method} on the first {num_assets_quantum} assets: {', '.join(tickers[:num_assets_quantum])}"
         }
     }
     return results
\ No newline at end of file
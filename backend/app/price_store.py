@@ -0,0 +1,108 @@
+# backend/app/price_store.py
+
+import os
+import json
+import threading
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import yfinance as yf
+
+# --- ON-DISK PRICE STORE ---
+# One parquet file per ticker holding adjusted daily closes, plus the [start, end)
+# window already downloaded (kept in the schema metadata). Requests only hit
+# Yahoo Finance for the part of their window the store does not cover yet.
+
+STORE_DIR = Path(os.getenv("MARKET_DATA_DIR", Path(__file__).resolve().parent.parent / "data_store"))
+
+_store_lock = threading.Lock()
+
+def _store_path(ticker):
+    return STORE_DIR / f"{ticker.upper()}.parquet"
+
+def _read_history(ticker):
+    """Stored closes and the window they cover, or (None, None) if the ticker was never fetched."""
+    path = _store_path(ticker)
+    if not path.exists():
+        return None, None
+    table = pq.read_table(path)
+    coverage = [pd.Timestamp(day) for day in json.loads(table.schema.metadata[b"coverage"])]
+    return table.to_pandas()["Close"], coverage
+
+def _write_history(ticker, closes, coverage):
+    table = pa.Table.from_pandas(closes.to_frame("Close"))
+    metadata = {**(table.schema.metadata or {}), b"coverage": json.dumps([day.isoformat() for day in coverage]).encode()}
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    path = _store_path(ticker)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp") # Per process, since uvicorn workers share the store
+    pq.write_table(table.replace_schema_metadata(metadata), tmp_path)
+    os.replace(tmp_path, path) # Atomic, so concurrent workers never read a partial file
+
+def _splice(stored, fresh):
+    """Joins a fresh download onto stored closes.
+
+    Adjusted closes are rescaled by Yahoo after every split or dividend, so the
+    stored part is rescaled onto the fresh download's basis using the latest
+    overlapping day before the two are joined.
+    """
+    overlap = stored.index.intersection(fresh.index)
+    if len(overlap):
+        day = overlap[-1]
+        stored = stored * (fresh[day] / stored[day])
+    return pd.concat([stored.drop(overlap), fresh]).sort_index()
+
+def _download(tickers, start, end):
+    data = yf.download(tickers, start=start.strftime("%Y-%m-%d"), end=end.strftime("%Y-%m-%d"),
+                       auto_adjust=True, progress=False)
+    if data.empty:
+        return pd.DataFrame()
+    closes = data['Close']
+    if isinstance(closes, pd.Series):
+        closes = closes.to_frame(tickers[0])
+    return closes
+
+def load_closes(tickers, start, end):
+    """Adjusted closes over [start, end) keyed by ticker; tickers with no data are left out."""
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    covered_until = min(end, pd.Timestamp.today().normalize()) # Today's bar may still change
+
+    with _store_lock:
+        stored = {ticker: _read_history(ticker) for ticker in tickers}
+
+    # Tickers missing the same window share one (internally threaded) download.
+    # Head and tail windows overlap the stored data by a day so _splice can rescale.
+    windows = {}
+    for ticker, (closes, coverage) in stored.items():
+        if closes is None:
+            windows.setdefault((start, end), []).append(ticker)
+            continue
+        if start < coverage[0]:
+            windows.setdefault((start, closes.index.min() + pd.Timedelta(days=1)), []).append(ticker)
+        if covered_until > coverage[1]:
+            windows.setdefault((closes.index.max(), end), []).append(ticker)
+    downloads = {window: _download(window_tickers, *window) for window, window_tickers in windows.items()}
+
+    result = {}
+    for ticker, (closes, coverage) in stored.items():
+        updated, incomplete = closes, False
+        for window, window_tickers in windows.items():
+            if ticker not in window_tickers:
+                continue
+            fetched = downloads[window]
+            fresh = fetched[ticker].dropna() if ticker in fetched.columns else pd.Series(dtype=float)
+            if fresh.empty:
+                # yfinance returns nothing instead of raising on errors; a head or tail window always
+                # overlaps a stored day, so an empty one means the stored closes would come back truncated
+                incomplete = True
+                continue
+            updated = fresh if updated is None else _splice(updated, fresh)
+        if updated is None or incomplete:
+            continue
+        if updated is not closes:
+            new_coverage = [start, covered_until] if coverage is None else [min(start, coverage[0]), max(covered_until, coverage[1])]
+            with _store_lock:
+                _write_history(ticker, updated, new_coverage)
+        result[ticker] = updated[(updated.index >= start) & (updated.index < end)]
+    return result